@@ -1,2 +1,3 @@
 import commands.vpc as vpc
-import commands.ec2 as ec2
\ No newline at end of file
+import commands.ec2 as ec2
+import commands.batcher as batcher
\ No newline at end of file
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import threading
+import time
+
+BATCHED_OPERATIONS = ("describe_vpcs", "describe_subnets")
+BATCH_WINDOW = 0.3  # seconds
+
+
+class BatchingEC2Client:
+    """
+    Proxy of EC2 client that coalesces identical `DescribeVpcs` and `DescribeSubnets` calls issued within BATCH_WINDOW
+    seconds into a single API call. Since resolved resource IDs are already cached by `fetch_*` methods of
+    `commands.vpc` and each CLI process runs exactly one command, the proxy only deduplicates concurrent cache misses of
+    steps running within the same stage. `DescribeInstances` is not coalesced, since the instance is looked up through
+    paginator and its state is polled by waiters, both of which use underlying client directly. Any mutating call made
+    through the proxy discards coalesced responses since they may not reflect the latest state anymore, and response of
+    a call that was in flight while mutating call was made is not recorded at all.
+    """
+
+    def __init__(self, ec2_client, batch_window: float = BATCH_WINDOW):
+        """
+        :param ec2_client: EC2 client created by boto3 session
+        :param batch_window: length of time window(in seconds) within which identical calls are coalesced
+        """
+        self._client = ec2_client
+        self._batch_window = batch_window
+        self._responses = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._generation = 0  # incremented by every mutating call
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._client, name)
+        if name in BATCHED_OPERATIONS:
+            return lambda **kwargs: self._batched_call(name, attribute, kwargs)
+        elif name in self._client.meta.method_to_api_mapping and not name.startswith("describe_"):
+            return lambda **kwargs: self._mutating_call(attribute, kwargs)
+        else:
+            return attribute
+
+    def _batched_call(self, name: str, operation, kwargs: dict) -> dict:
+        """
+        Return response of identical call issued within the window, or issue the call and record its response. Calls
+        with same request key wait for each other, so concurrent identical calls also result in single API call.
+        :param name: name of the operation
+        :param operation: bound method of underlying client
+        :param kwargs: request parameters
+        :return: response of the operation
+        """
+        request_key = self._request_key(name, kwargs)
+        with self._lock:
+            request_lock = self._locks.setdefault(request_key, threading.Lock())
+        with request_lock:
+            recorded = self._responses.get(request_key)
+            if recorded is not None and time.monotonic() - recorded[0] < self._batch_window:
+                return recorded[1]
+            generation = self._generation
+            response = operation(**kwargs)
+            with self._lock:
+                if generation == self._generation:
+                    self._responses[request_key] = (time.monotonic(), response)
+            return response
+
+    def _mutating_call(self, operation, kwargs: dict):
+        """
+        :param operation: bound method of underlying client
+        :param kwargs: request parameters
+        :return: response of the operation
+        """
+        try:
+            return operation(**kwargs)
+        finally:
+            with self._lock:
+                self._generation += 1
+                self._responses.clear()
+
+    @staticmethod
+    def _request_key(name: str, kwargs: dict) -> str:
+        """
+        :param name: name of the operation
+        :param kwargs: request parameters that should be JSON serializable
+        :return: hash of the operation name with its parameters
+        """
+        request = json.dumps([name, kwargs], sort_keys=True, default=str)
+        return hashlib.sha1(request.encode()).hexdigest()
@@ -1,12 +1,14 @@
+import functools
 import pathlib
-import time
 
 from commands.vpc import fetch_vpc_security_group_id, fetch_subnet_id
 
 INSTANCE_NAME = "cifar10"
 KEY_NAME = "workspace"
+WAITER_CONFIG = {"Delay": 5, "MaxAttempts": 60}
 
 
+@functools.lru_cache(maxsize=1)
 def get_ami_id(ec2_client):
     response = ec2_client.describe_images(
         Owners=["amazon"],
@@ -21,10 +23,18 @@ def get_ami_id(ec2_client):
             {
                 "Name": "state",
                 "Values": ["available"]
+            },
+            {
+                "Name": "architecture",
+                "Values": ["x86_64"]
+            },
+            {
+                "Name": "root-device-type",
+                "Values": ["ebs"]
             }
         ]
     )["Images"]
-    ami = sorted(response, key=lambda x: x["CreationDate"], reverse=True)[0]
+    ami = max(response, key=lambda x: x["CreationDate"])
     return ami["ImageId"]
 
 
@@ -35,13 +45,14 @@ def create_key_pair(ec2_client, local_dir: pathlib.Path):
     :param local_dir: path to directory to save key pair file
     :return: None
     """
+    local_dir.mkdir(parents=True, exist_ok=True)
     key_info = ec2_client.create_key_pair(
         KeyName=KEY_NAME,
         DryRun=False,
         KeyType="rsa",
         KeyFormat="pem",
     )
-    key_path = local_dir.joinpath(f"{KEY_NAME}.pem")
+    key_path = _key_path(local_dir)
     with open(key_path, "w") as file:
         file.write(key_info["KeyMaterial"])
     key_path.chmod(0o400)  # python equivalent to 'chmod 400 key_path'
@@ -69,12 +80,9 @@ def run_instance(ec2_client):
         ]
     )
     instance_id = response["Instances"][0]["InstanceId"]
-    is_running = False
-    while not is_running:
-        time.sleep(3)
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        instance_info = response["Reservations"][0]["Instances"][0]
-        is_running = instance_info["State"]["Name"] == "running"
+    ec2_client.get_waiter("instance_running").wait(
+        InstanceIds=[instance_id], WaiterConfig=WAITER_CONFIG
+    )
 
 
 def stop_instance(ec2_client):
@@ -83,20 +91,11 @@ def stop_instance(ec2_client):
     :param ec2_client: EC2 client created by boto3 session
     :return: None
     """
-    instance_info = ec2_client.describe_instances(
-        Filters=[
-            {"Name": "tag:Name", "Values": [INSTANCE_NAME]},
-            {"Name": "subnet-id", "Values": [fetch_subnet_id(ec2_client)]}
-        ]
-    )["Reservations"][0]["Instances"][0]
-    instance_id = instance_info["InstanceId"]
+    instance_id = _get_instance_id(ec2_client)
     ec2_client.stop_instances(InstanceIds=[instance_id])
-    is_stopped = False
-    while not is_stopped:
-        time.sleep(3)
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        instance_info = response["Reservations"][0]["Instances"][0]
-        is_stopped = instance_info["State"]["Name"] == "stopped"
+    ec2_client.get_waiter("instance_stopped").wait(
+        InstanceIds=[instance_id], WaiterConfig=WAITER_CONFIG
+    )
 
 
 def start_instance(ec2_client):
@@ -105,20 +104,11 @@ def start_instance(ec2_client):
     :param ec2_client: EC2 client created by boto3 session
     :return: None
     """
-    instance_info = ec2_client.describe_instances(
-        Filters=[
-            {"Name": "tag:Name", "Values": [INSTANCE_NAME]},
-            {"Name": "subnet-id", "Values": [fetch_subnet_id(ec2_client)]}
-        ]
-    )["Reservations"][0]["Instances"][0]
-    instance_id = instance_info["InstanceId"]
+    instance_id = _get_instance_id(ec2_client)
     ec2_client.start_instances(InstanceIds=[instance_id])
-    is_running = False
-    while not is_running:
-        time.sleep(3)
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        instance_info = response["Reservations"][0]["Instances"][0]
-        is_running = instance_info["State"]["Name"] == "running"
+    ec2_client.get_waiter("instance_running").wait(
+        InstanceIds=[instance_id], WaiterConfig=WAITER_CONFIG
+    )
 
 
 def reboot_instance(ec2_client):
@@ -127,20 +117,12 @@ def reboot_instance(ec2_client):
     :param ec2_client: EC2 client created by boto3 session
     :return: None
     """
-    instance_info = ec2_client.describe_instances(
-        Filters=[
-            {"Name": "tag:Name", "Values": [INSTANCE_NAME]},
-            {"Name": "subnet-id", "Values": [fetch_subnet_id(ec2_client)]}
-        ]
-    )["Reservations"][0]["Instances"][0]
-    instance_id = instance_info["InstanceId"]
-    ec2_client.reboot_instances(InstanceIds=[instance_info["InstanceId"]])
-    is_running = False
-    while not is_running:
-        time.sleep(3)
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        instance_info = response["Reservations"][0]["Instances"][0]
-        is_running = instance_info["State"]["Name"] == "running"
+    instance_id = _get_instance_id(ec2_client)
+    ec2_client.reboot_instances(InstanceIds=[instance_id])
+    # rebooted instance never leaves 'running' state, so wait for status checks to pass instead
+    ec2_client.get_waiter("instance_status_ok").wait(
+        InstanceIds=[instance_id], WaiterConfig=WAITER_CONFIG
+    )
 
 
 def terminate_instance(ec2_client):
@@ -149,20 +131,11 @@ def terminate_instance(ec2_client):
     :param ec2_client: EC2 client created by boto3 session
     :return: None
     """
-    instance_info = ec2_client.describe_instances(
-        Filters=[
-            {"Name": "tag:Name", "Values": [INSTANCE_NAME]},
-            {"Name": "subnet-id", "Values": [fetch_subnet_id(ec2_client)]}
-        ]
-    )["Reservations"][0]["Instances"][0]
-    instance_id = instance_info["InstanceId"]
+    instance_id = _get_instance_id(ec2_client)
     ec2_client.terminate_instances(InstanceIds=[instance_id])
-    is_terminated = False
-    while not is_terminated:
-        time.sleep(3)
-        response = ec2_client.describe_instances(InstanceIds=[instance_id])
-        instance_info = response["Reservations"][0]["Instances"][0]
-        is_terminated = instance_info["State"]["Name"] == "terminated"
+    ec2_client.get_waiter("instance_terminated").wait(
+        InstanceIds=[instance_id], WaiterConfig=WAITER_CONFIG
+    )
 
 
 def describe_instance(ec2_client):
@@ -172,19 +145,7 @@ def describe_instance(ec2_client):
     :return: None
     """
     try:
-        response = ec2_client.describe_instances(
-            Filters=[
-                {
-                    "Name": "subnet-id",
-                    "Values": [fetch_subnet_id(ec2_client)]
-                },
-                {
-                    "Name": "tag:Name",
-                    "Values": [INSTANCE_NAME]
-                }
-            ]
-        )
-        instance_info = response["Reservations"][0]["Instances"][0]
+        instance_info = _get_instance_info(ec2_client)
         state = instance_info["State"]["Name"]
         print(f"CURRENT STATE  : {state}")
         if state == "running":
@@ -200,5 +161,42 @@ def delete_key_pair(ec2_client, local_dir: pathlib.Path):
     :param local_dir: path to directory where key pair file was saved
     :return: None
     """
-    pathlib.os.remove(local_dir.joinpath(f"{KEY_NAME}.pem"))
+    _key_path(local_dir).unlink(missing_ok=True)
     ec2_client.delete_key_pair(KeyName=KEY_NAME)
+
+
+def _get_instance_info(ec2_client) -> dict:
+    """
+    This project assigns unique name tag to the instance, so filtering by name tag is enough to identify it. Terminated
+    instances are excluded since they may remain visible under the same tag for a while.
+    :param ec2_client: EC2 client created by boto3 session
+    :return: information of the instance
+    """
+    pages = ec2_client.get_paginator("describe_instances").paginate(
+        Filters=[
+            {"Name": "tag:Name", "Values": [INSTANCE_NAME]},
+            {"Name": "instance-state-name", "Values": ["pending", "running", "stopping", "stopped"]},
+        ],
+        PaginationConfig={"PageSize": 5},  # filtered page may be short or even empty while more results exist
+    )
+    for page in pages:
+        for reservation in page["Reservations"]:
+            for instance_info in reservation["Instances"]:
+                return instance_info
+    raise ValueError(f"Instance with name '{INSTANCE_NAME}' does not exists")
+
+
+def _get_instance_id(ec2_client) -> str:
+    """
+    :param ec2_client: EC2 client created by boto3 session
+    :return: InstanceId
+    """
+    return _get_instance_info(ec2_client)["InstanceId"]
+
+
+def _key_path(local_dir: pathlib.Path) -> pathlib.Path:
+    """
+    :param local_dir: path to directory where key pair file is saved
+    :return: path to key pair file
+    """
+    return local_dir.joinpath(f"{KEY_NAME}.pem")
@@ -1,4 +1,7 @@
-from typing import List
+import functools
+import re
+
+from typing import List, Optional
 
 VPC_NAME = "workspace"
 VPC_CIDR = "172.50.0.0/16"  # subnet mask = 255.255.0.0
@@ -44,7 +47,7 @@ def create_vpc_security_group(ec2_client):
     sg_id = response["GroupId"]
     ec2_client.authorize_security_group_ingress(
         GroupId=sg_id,
-        IpPermissions=_parse_ip_permissions(INGRESS_PORTS)
+        IpPermissions=_INGRESS_PERMISSIONS
     )
 
 
@@ -68,14 +71,15 @@ def create_vpc_internet_gateway(ec2_client):
     )
 
 
-def create_subnet(ec2_client, region_name: str):
+def create_subnet(ec2_client, region_name: Optional[str] = None):
     """
     Create a subnet within a VPC. Subnet attribute 'MapPubilcIpOnLaunch' is modified to True to assign public IPv4
     address to instance created within the subnet.
     :param ec2_client: EC2 client created by boto3 session
-    :param region_name: name of region
+    :param region_name: name of region; defaults to the region that the client is bound to
     :return: None
     """
+    region_name = region_name or ec2_client.meta.region_name
     vpc_id = fetch_vpc_id(ec2_client)
     vpc_info = ec2_client.describe_vpcs(
         Filters=[{"Name": "vpc-id", "Values": [vpc_id]}]
@@ -144,11 +148,13 @@ def create_route_table_subnet_association(ec2_client):
     ec2_client.associate_route_table(RouteTableId=rt_id, SubnetId=subnet_id)
 
 
+@functools.lru_cache(maxsize=None)
 def fetch_vpc_id(ec2_client) -> str:
     """
     This project assigns unique name to unique VPC, so normal response should contain only one set of VPC information.
     If list is empty, it means that VPC is not created. If there are multiple VPCs with given name, it must be that
-    one of VPCs is created from outside of this project.
+    one of VPCs is created from outside of this project. Resolved ID is cached per client since it never changes
+    for the lifetime of the VPC; `invalidate_cache` has to be called whenever tagged resource gets deleted.
     :param ec2_client: EC2 client created by boto3 session
     :return: VpcId
     """
@@ -163,6 +169,7 @@ def fetch_vpc_id(ec2_client) -> str:
         raise ValueError(f"VPC whose name tag value is '{VPC_NAME}' is ambiguous")
 
 
+@functools.lru_cache(maxsize=None)
 def fetch_vpc_security_group_id(ec2_client) -> str:
     """
     One-to-one correspondence between security group and sg_name is checked as explained in `fetch_vpc_id` method.
@@ -184,6 +191,7 @@ def fetch_vpc_security_group_id(ec2_client) -> str:
         raise ValueError(f"Security group with GroupName '{sg_name}' is ambiguous")
 
 
+@functools.lru_cache(maxsize=None)
 def fetch_subnet_id(ec2_client) -> str:
     """
     One-to-one correspondence between subnet and SUBNET_NAME is checked as explained in `fetch_vpc_id` method.
@@ -204,6 +212,16 @@ def fetch_subnet_id(ec2_client) -> str:
         raise ValueError(f"Subnet whose name tag value is '{SUBNET_NAME}' is ambiguous")
 
 
+def invalidate_cache():
+    """
+    Clear resolved resource IDs cached by `fetch_vpc_id`, `fetch_vpc_security_group_id` and `fetch_subnet_id`
+    :return: None
+    """
+    fetch_vpc_id.cache_clear()
+    fetch_vpc_security_group_id.cache_clear()
+    fetch_subnet_id.cache_clear()
+
+
 def delete_route_table_subnet_association(ec2_client):
     """
     Delete association between route table and subnet
@@ -248,6 +266,7 @@ def delete_subnet(ec2_client):
     """
     subnet_id = fetch_subnet_id(ec2_client)
     ec2_client.delete_subnet(SubnetId=subnet_id)
+    invalidate_cache()
 
 
 def delete_vpc_security_group(ec2_client):
@@ -258,6 +277,7 @@ def delete_vpc_security_group(ec2_client):
     """
     security_group_id = fetch_vpc_security_group_id(ec2_client)
     ec2_client.delete_security_group(GroupId=security_group_id)
+    invalidate_cache()
 
 
 def delete_vpc_internet_gateway(ec2_client):
@@ -283,6 +303,7 @@ def delete_vpc(ec2_client):
     """
     vpc_id = fetch_vpc_id(ec2_client)
     ec2_client.delete_vpc(VpcId=vpc_id)
+    invalidate_cache()
 
 
 def _parse_ip_permissions(ingress_ports: List[str]):
@@ -296,16 +317,13 @@ def _parse_ip_permissions(ingress_ports: List[str]):
     """
     permission_statements = []
     for ingress_port in ingress_ports:
-        try:
-            from_port = int(ingress_port)
-            to_port = int(ingress_port)
-        except ValueError:  # ValueError with message 'invalid literal for int() with base 10'
-            if "-" in ingress_port:
-                from_port, to_port = map(int, ingress_port.split("-"))
-            else:
-                raise ValueError(
-                    f"ingress_port should be either integer or contains '-' as separator; got {ingress_port}"
-                )
+        matched = re.fullmatch(r"(\d+)(?:-(\d+))?", ingress_port)
+        if matched is None:
+            raise ValueError(
+                f"ingress_port should be either integer or contains '-' as separator; got {ingress_port}"
+            )
+        from_port = int(matched.group(1))
+        to_port = int(matched.group(2) or matched.group(1))
         if from_port == to_port:
             description = f"allow any connection attempt on port {from_port}"
         else:
@@ -323,3 +341,6 @@ def _parse_ip_permissions(ingress_ports: List[str]):
         }
         permission_statements.append(parsed_permission)
     return permission_statements
+
+
+_INGRESS_PERMISSIONS = _parse_ip_permissions(INGRESS_PORTS)  # INGRESS_PORTS never changes, so parse once
@@ -3,16 +3,18 @@ import pandas as pd
 import tensorflow as tf
 import numpy as np
 import pathlib
-import matplotlib.pyplot as plt
+import pickle
 
 from model import LOCAL_DIR
 from typing import Tuple
 
 local_dir = pathlib.Path(LOCAL_DIR)
+test_batch_path = pathlib.Path.home().joinpath(".keras", "datasets", "cifar-10-batches-py", "test_batch")
 label_names = [
     "airplane", "automobile", "bird", "cat", "deer", "dog", "frog", "horse", "ship", "truck"
 ]
-label_decoder = dict(enumerate(label_names))
+label_decoder = np.array(label_names)
+result_indices = pd.CategoricalIndex(label_names)
 
 
 @st.cache_resource
@@ -25,28 +27,42 @@ def load_train_history() -> pd.DataFrame:
     return pd.read_csv(local_dir.joinpath("training_log.csv"))
 
 
+@st.cache_resource
 def load_test_data() -> Tuple[np.array, np.array]:
-    _, (images, labels) = tf.keras.datasets.cifar10.load_data()
+    """
+    Read test batch of CIFAR10 dataset directly from Keras cache directory, so that training batches are not loaded.
+    If the dataset has not been downloaded yet, fall back to Keras dataset API which downloads it. Images are converted
+    into float32 standardized values once here, so that they can be fed into the model without further conversion.
+    Arrays are cached as a resource shared by every rerun instead of being copied per rerun, so they are made read-only.
+    :return: array of standardized test images(shape: (10000, 32, 32, 3)) with corresponding labels(shape: (10000, 1))
+    """
+    if test_batch_path.exists():
+        with open(test_batch_path, "rb") as file:
+            test_batch = pickle.load(file, encoding="bytes")
+        images = test_batch[b"data"].reshape(-1, 3, 32, 32).transpose(0, 2, 3, 1)
+        labels = np.array(test_batch[b"labels"], dtype=np.uint8).reshape(-1, 1)
+    else:
+        _, (images, labels) = tf.keras.datasets.cifar10.load_data()
+    images = images.astype(np.float32)
+    images *= np.float32(1 / 255.)
+    images.flags.writeable = False
+    labels.flags.writeable = False
     return images, labels
 
 
 def decode_labels(labels: np.array) -> np.array:
-    labels = labels.flatten()
-    names = list(map(lambda x: label_decoder[x], labels))
-    return np.array(names)
+    return label_decoder[labels.flatten()]
 
 
 model = load_pretrained_model()
 train_history = load_train_history()
 images, labels = load_test_data()
 labels = labels.flatten()
-result_indices = list(label_decoder.values())
 st.title("Pretrained Image Classifiers Demo")
 
 if st.sidebar.button("Refresh"):
     random_index = np.random.randint(0, images.shape[0])
-    sample_image = images[random_index][np.newaxis, :, :, :] / 255.
-    sample_image = sample_image.astype(np.float32)
+    sample_image = images[random_index:random_index + 1]
     sample_image_label = labels[random_index]
     text_column, sample_image_column = st.columns(spec=[0.85, 0.15])
     with text_column:
@@ -56,22 +72,18 @@ if st.sidebar.button("Refresh"):
         Decision rule is to pick label whose softmax value is highest compared to others.
         """
     with sample_image_column:
-        fig, ax = plt.subplots(1, 1)
-        ax.imshow(images[random_index])
-        ax.set_xticks([])
-        ax.set_yticks([])
-        st.pyplot(fig)
+        st.image(images[random_index], width=96, clamp=True)
         st.caption(f"label: {label_decoder[sample_image_label]}")
 
     st.header("CNN Model Prediction Result")
-    cnn_scores = model(sample_image)[0]
-    cnn_prediction = np.argmax(cnn_scores)
-    predicted_label = label_decoder[int(cnn_prediction)]
+    cnn_scores = np.asarray(tf.nn.softmax(model(sample_image))[0], dtype=np.float32)  # model outputs logits
+    cnn_prediction = int(cnn_scores.argmax())
+    predicted_label = label_decoder[cnn_prediction]
     if cnn_prediction == sample_image_label:
         st.success(f"Prediction result of CNN model is correct(label: {predicted_label})", icon="✅")
     else:
         st.warning(f"CNN model failed to give correct prediction(label: {predicted_label})", icon="⚠️")
-    st.bar_chart(pd.DataFrame({"softmax scores(CNN)": cnn_scores}, index=result_indices))
+    st.bar_chart(pd.DataFrame({"softmax scores(CNN)": pd.array(cnn_scores, dtype="float32")}, index=result_indices))
 else:
     st.text("Click `Refresh` button on the sidebar")
 
@@ -1,30 +1,103 @@
 import boto3
+import functools
 import pathlib
 import commands.ec2 as ec2_commands
 import commands.vpc as vpc_commands
 import typer
 
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from commands.batcher import BatchingEC2Client
+
 app = typer.Typer()
 
 
+@functools.lru_cache(maxsize=8)
+def _get_ec2_client(profile_name: str, region_name: str) -> BatchingEC2Client:
+    """
+    Create EC2 client once per profile and region, so that credential resolution and connection pool to the endpoint
+    are reused by every command executed within the same process
+    :param profile_name: name of AWS CLI profile
+    :param region_name: name of region
+    :return: EC2 client created by boto3 session
+    """
+    config = Config(
+        retries={"mode": "adaptive", "total_max_attempts": 10},
+        max_pool_connections=50,
+        tcp_keepalive=True,
+    )
+    session = boto3.Session(profile_name=profile_name, region_name=region_name)
+    return BatchingEC2Client(session.client("ec2", config=config))
+
+
+# each action is a sequence of stages, and steps grouped within a stage do not depend on each other
+_VPC_ACTIONS = {
+    "create": (
+        (vpc_commands.create_vpc,),
+        (vpc_commands.create_vpc_security_group, vpc_commands.create_vpc_internet_gateway),
+    ),
+    "delete": (
+        (vpc_commands.delete_vpc_security_group, vpc_commands.delete_vpc_internet_gateway),
+        (vpc_commands.delete_vpc,),
+    ),
+}
+_SUBNET_ACTIONS = {
+    "create": (
+        (vpc_commands.create_subnet, vpc_commands.create_route_table),
+        (vpc_commands.create_route_table_subnet_association,),
+    ),
+    "delete": (
+        (vpc_commands.delete_route_table_subnet_association,),
+        (vpc_commands.delete_route_table, vpc_commands.delete_subnet),
+    ),
+}
+_INSTANCE_ACTIONS = {
+    "run": ec2_commands.run_instance,
+    "start": ec2_commands.start_instance,
+    "stop": ec2_commands.stop_instance,
+    "reboot": ec2_commands.reboot_instance,
+    "terminate": ec2_commands.terminate_instance,
+    "describe": ec2_commands.describe_instance,
+}
+_KEY_PAIR_ACTIONS = {
+    "create": ec2_commands.create_key_pair,
+    "delete": ec2_commands.delete_key_pair,
+}
+
+
+def _get_action(actions: dict, action_type: str):
+    """
+    :param actions: dispatch table of a command
+    :param action_type: name of the action given by user
+    :return: value of dispatch table that corresponds to given action
+    """
+    action = actions.get(action_type.lower())
+    if action is None:
+        raise ValueError(f"action_type must be one of {tuple(actions)}; got: '{action_type}'")
+    return action
+
+
+def _run_stages(stages: tuple, ec2_client):
+    """
+    Run stages consecutively, where steps within each stage are executed concurrently over the shared client
+    :param stages: sequence of stages defined in dispatch table
+    :param ec2_client: EC2 client created by boto3 session
+    :return: None
+    """
+    with ThreadPoolExecutor(max_workers=max(map(len, stages))) as executor:
+        for stage in stages:
+            list(executor.map(lambda step: step(ec2_client), stage))
+
+
 @app.command("vpc")
 def manage_vpc(
         action_type: str = typer.Argument(...),
         profile_name: str = typer.Argument(...),
         region_name: str = typer.Argument("ap-northeast-2"),
 ):
-    session = boto3.Session(profile_name=profile_name, region_name=region_name)
-    ec2_client = session.client("ec2")
-    if action_type.lower() == "create":
-        vpc_commands.create_vpc(ec2_client)
-        vpc_commands.create_vpc_security_group(ec2_client)
-        vpc_commands.create_vpc_internet_gateway(ec2_client)
-    elif action_type.lower() == "delete":
-        vpc_commands.delete_vpc_security_group(ec2_client)
-        vpc_commands.delete_vpc_internet_gateway(ec2_client)
-        vpc_commands.delete_vpc(ec2_client)
-    else:
-        raise ValueError(f"action_type must be one of ('create', 'delete'); got: '{action_type}'")
+    stages = _get_action(_VPC_ACTIONS, action_type)
+    ec2_client = _get_ec2_client(profile_name, region_name)
+    _run_stages(stages, ec2_client)
 
 
 @app.command("subnet")
@@ -33,18 +106,9 @@ def manage_subnet(
         profile_name: str = typer.Argument(...),
         region_name: str = typer.Argument("ap-northeast-2"),
 ):
-    session = boto3.Session(profile_name=profile_name, region_name=region_name)
-    ec2_client = session.client("ec2")
-    if action_type.lower() == "create":
-        vpc_commands.create_subnet(ec2_client, region_name)
-        vpc_commands.create_route_table(ec2_client)
-        vpc_commands.create_route_table_subnet_association(ec2_client)
-    elif action_type.lower() == "delete":
-        vpc_commands.delete_route_table_subnet_association(ec2_client)
-        vpc_commands.delete_route_table(ec2_client)
-        vpc_commands.delete_subnet(ec2_client)
-    else:
-        raise ValueError(f"action_type must be one of ('create', 'delete'); got: '{action_type}'")
+    stages = _get_action(_SUBNET_ACTIONS, action_type)
+    ec2_client = _get_ec2_client(profile_name, region_name)
+    _run_stages(stages, ec2_client)
 
 
 @app.command("instance")
@@ -53,24 +117,9 @@ def manage_instance(
         profile_name: str = typer.Argument(...),
         region_name: str = typer.Argument("ap-northeast-2"),
 ):
-    session = boto3.Session(profile_name=profile_name, region_name=region_name)
-    ec2_client = session.client("ec2")
-    if action_type.lower() == "run":
-        ec2_commands.run_instance(ec2_client)
-    elif action_type.lower() == "start":
-        ec2_commands.start_instance(ec2_client)
-    elif action_type.lower() == "stop":
-        ec2_commands.stop_instance(ec2_client)
-    elif action_type.lower() == "reboot":
-        ec2_commands.reboot_instance(ec2_client)
-    elif action_type.lower() == "terminate":
-        ec2_commands.terminate_instance(ec2_client)
-    elif action_type.lower() == "describe":
-        ec2_commands.describe_instance(ec2_client)
-    else:
-        raise ValueError(
-            f"action_type must be one of ('run', 'start', 'stop', 'reboot', 'terminate', 'describe'); got: '{action_type}'"
-        )
+    action = _get_action(_INSTANCE_ACTIONS, action_type)
+    ec2_client = _get_ec2_client(profile_name, region_name)
+    action(ec2_client)
 
 
 @app.command("key-pair")
@@ -80,16 +129,9 @@ def manage_key_pair(
         region_name: str = typer.Argument("ap-northeast-2"),
         key_dir: str = typer.Argument("."),
 ):
-    session = boto3.Session(profile_name=profile_name, region_name=region_name)
-    ec2_client = session.client("ec2")
-    local_dir = pathlib.Path(key_dir).resolve()
-    local_dir.mkdir(parents=True, exist_ok=True)
-    if action_type.lower() == "create":
-        ec2_commands.create_key_pair(ec2_client, local_dir)
-    elif action_type.lower() == "delete":
-        ec2_commands.delete_key_pair(ec2_client, local_dir)
-    else:
-        raise ValueError(f"action_type must be one of ('create', 'delete'); got: '{action_type}'")
+    action = _get_action(_KEY_PAIR_ACTIONS, action_type)
+    ec2_client = _get_ec2_client(profile_name, region_name)
+    action(ec2_client, pathlib.Path(key_dir).resolve())
 
 
 if __name__ == "__main__":
@@ -1,10 +1,12 @@
 import tensorflow as tf
 import numpy as np
+import csv
+import math
 import pathlib
 import logging
 import sys
 
-from typing import Tuple, List
+from typing import Tuple, List, Optional, Union
 
 formatter = logging.Formatter(
     fmt="%(asctime)s : %(msg)s",
@@ -17,131 +19,340 @@ logger.addHandler(stream_handler)
 logger.setLevel(logging.INFO)
 
 LOCAL_DIR = "/tmp/cifar10"
+IMAGE_SHAPE = (32, 32, 3)
+NUM_SHARDS = 16
+NUM_TRAIN_EXAMPLES = 50000
+EPOCHS = 30
+BATCH_SIZE = 512  # per replica
+MAX_LEARNING_RATE = 1e-2
 
 
-def define_model_cnn(input_shape: Tuple[int, int, int]) -> tf.keras.Model:
-    model = tf.keras.Sequential(
-        [
-            tf.keras.layers.Conv2D(
-                filters=32,
-                kernel_size=(3, 3),
-                activation="relu",
-                padding="SAME",
-                name="convolution_1",
-                input_shape=input_shape
-            ),
-            tf.keras.layers.Conv2D(
-                filters=32,
-                kernel_size=(3, 3),
-                activation="relu",
-                padding="SAME",
-                name="convolution_2"
-            ),
-            tf.keras.layers.MaxPooling2D(pool_size=(2, 2), name="max_pool_1"),
-            tf.keras.layers.BatchNormalization(name="batch_normalization_1"),
-            tf.keras.layers.Dropout(0.5, name="dropout_1"),
-            tf.keras.layers.Conv2D(
-                filters=64,
-                kernel_size=(3, 3),
-                activation="relu",
-                padding="SAME",
-                name="convolution_3"
-            ),
-            tf.keras.layers.Conv2D(
-                filters=64,
-                kernel_size=(3, 3),
-                activation="relu",
-                padding="SAME",
-                name="convolution_4"
-            ),
-            tf.keras.layers.MaxPooling2D(pool_size=(2, 2), name="max_pool_2"),
-            tf.keras.layers.BatchNormalization(name="batch_normalization_2"),
-            tf.keras.layers.Dropout(0.5, name="dropout_2"),
-            tf.keras.layers.Conv2D(
-                filters=128,
+class WarmupCosineDecay(tf.keras.optimizers.schedules.LearningRateSchedule):
+    """
+    Increase learning rate linearly up to peak value during warmup steps, then decay it to zero by cosine schedule.
+    Warmup keeps early updates from diverging when peak value is scaled up for large batch.
+    """
+
+    def __init__(self, peak_learning_rate: float, warmup_steps: int, total_steps: int):
+        super().__init__()
+        if not 0 < warmup_steps < total_steps:
+            raise ValueError(
+                f"warmup_steps should be positive and less than total_steps({total_steps}); got {warmup_steps}"
+            )
+        self.peak_learning_rate = peak_learning_rate
+        self.warmup_steps = warmup_steps
+        self.total_steps = total_steps
+
+    def __call__(self, step):
+        step = tf.cast(step, tf.float32)
+        warmup_learning_rate = self.peak_learning_rate * step / self.warmup_steps
+        progress = tf.clip_by_value(
+            (step - self.warmup_steps) / max(self.total_steps - self.warmup_steps, 1), 0.0, 1.0
+        )
+        decayed_learning_rate = 0.5 * self.peak_learning_rate * (1.0 + tf.cos(math.pi * progress))
+        return tf.where(step < self.warmup_steps, warmup_learning_rate, decayed_learning_rate)
+
+    def get_config(self) -> dict:
+        return {
+            "peak_learning_rate": self.peak_learning_rate,
+            "warmup_steps": self.warmup_steps,
+            "total_steps": self.total_steps,
+        }
+
+
+def define_convolution_block(filters: int, block_index: int, data_format: str) -> List[tf.keras.layers.Layer]:
+    """
+    Define block of two convolutions, where the second one downsamples features by strides instead of max pooling.
+    Bias is omitted since following batch normalization cancels it out, and batch normalization precedes ReLU so that
+    cuDNN can fuse them into single kernel. Convolutions are depthwise-separable to cut FLOPs, except for the first
+    one of the model since depthwise convolution over 3 input channels saves almost nothing.
+    :param filters: number of filters of convolutions within the block
+    :param block_index: index of the block(starts from 1) used to name its layers
+    :param data_format: either 'channels_first'(NCHW) or 'channels_last'(NHWC)
+    :return: list of layers that compose the block
+    """
+    layers = []
+    for layer_index, strides in [(2 * block_index - 1, (1, 1)), (2 * block_index, (2, 2))]:
+        convolution = tf.keras.layers.Conv2D if layer_index == 1 else tf.keras.layers.SeparableConv2D
+        layers += [
+            convolution(
+                filters=filters,
                 kernel_size=(3, 3),
-                activation="relu",
+                strides=strides,
                 padding="SAME",
-                name="convolution_5"
+                use_bias=False,
+                data_format=data_format,
+                name=f"convolution_{layer_index}"
             ),
-            tf.keras.layers.Conv2D(
-                filters=128,
-                kernel_size=(3, 3),
-                activation="relu",
-                padding="SAME",
-                name="convolution_6"
+            tf.keras.layers.BatchNormalization(
+                axis=1 if data_format == "channels_first" else -1,
+                name=f"batch_normalization_{layer_index}"
             ),
-            tf.keras.layers.MaxPooling2D(pool_size=(2, 2), name="max_pool_3"),
-            tf.keras.layers.BatchNormalization(name="batch_normalization_3"),
-            tf.keras.layers.Dropout(0.5, name="dropout_3"),
+            tf.keras.layers.ReLU(name=f"relu_{layer_index}"),
+        ]
+    # drop whole feature maps instead of single activations
+    layers.append(tf.keras.layers.SpatialDropout2D(0.3, data_format=data_format, name=f"sdropout_{block_index}"))
+    return layers
+
+
+def define_model_cnn(
+        input_shape: Tuple[int, int, int],
+        learning_rate: Union[float, tf.keras.optimizers.schedules.LearningRateSchedule] = 1e-3,
+) -> tf.keras.Model:
+    """
+    Define CNN classifier that receives NHWC images. Under float32 policy, convolution blocks operate on NCHW layout
+    which float32 cuDNN convolutions run on natively, so images are transposed only once by leading Permute layer.
+    Under mixed precision policies, tensor core convolutions prefer NHWC layout instead, so the blocks keep NHWC layout
+    and the transpose is omitted. Since XLA compiled training step may still assign its own layouts to convolutions,
+    the transpose is not guaranteed to replace any transpose XLA would insert. Note that model with NCHW layout runs
+    only on GPU, since TensorFlow does not provide NCHW(depthwise-separable) convolution kernels for CPU.
+    :param input_shape: shape of single NHWC image
+    :param learning_rate: learning rate or its schedule
+    :return: compiled model
+    """
+    if tf.keras.mixed_precision.global_policy().name == "float32":
+        data_format = "channels_first"
+        layout_layers = [tf.keras.layers.Permute((3, 1, 2), name="channels_first")]
+    else:
+        data_format = "channels_last"
+        layout_layers = []
+    model = tf.keras.Sequential(
+        [
+            tf.keras.Input(shape=input_shape),
+            *layout_layers,
+            *define_convolution_block(filters=32, block_index=1, data_format=data_format),
+            *define_convolution_block(filters=64, block_index=2, data_format=data_format),
+            *define_convolution_block(filters=128, block_index=3, data_format=data_format),
             tf.keras.layers.Flatten(),
             tf.keras.layers.Dense(128, activation="relu"),
-            tf.keras.layers.Dense(10, activation="sigmoid"),
+            # logits are kept in float32 under mixed precision policy to keep the loss numerically stable
+            tf.keras.layers.Dense(10, name="logits", dtype="float32"),
         ],
         name="cifar10_classifier_cnn"
     )
+    optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate, jit_compile=True)
+    if tf.keras.mixed_precision.global_policy().name == "mixed_float16":
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)  # prevent float16 gradient underflow
     model.compile(
-        optimizer=tf.keras.optimizers.legacy.Adam(),
-        loss=tf.keras.losses.SparseCategoricalCrossentropy(),
-        metrics=["accuracy"]
+        optimizer=optimizer,
+        loss=tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+        metrics=["accuracy"],
+        jit_compile=True,
     )
     return model
 
 
+def set_mixed_precision_policy() -> str:
+    """
+    Set global mixed precision policy that fits visible GPUs. GPUs from Ampere(compute capability 8.0) onward support
+    bfloat16 which does not require loss scaling, while Volta and Turing GPUs(compute capability 7.x) provide tensor
+    cores only for float16. Older GPUs gain nothing from reduced precision, so float32 is kept for them.
+    :return: name of the policy
+    """
+    gpus = tf.config.list_physical_devices("GPU")
+    capabilities = [tf.config.experimental.get_device_details(gpu).get("compute_capability", (0, 0)) for gpu in gpus]
+    if gpus and min(capabilities) >= (8, 0):
+        policy = "mixed_bfloat16"
+    elif gpus and min(capabilities) >= (7, 0):
+        policy = "mixed_float16"
+    else:
+        policy = "float32"
+    tf.keras.mixed_precision.set_global_policy(policy)
+    return policy
+
+
+def read_best_val_accuracy(log_path: pathlib.Path) -> Optional[float]:
+    """
+    :param log_path: path to training log written by CSVLogger
+    :return: highest val_accuracy logged so far, or None if no epoch is logged
+    """
+    if not log_path.exists():
+        return None
+    with open(log_path) as file:
+        val_accuracies = [float(row["val_accuracy"]) for row in csv.DictReader(file)]
+    return max(val_accuracies, default=None)
+
+
 def define_callbacks(local_dir: pathlib.Path) -> List[tf.keras.callbacks.Callback]:
+    """
+    Define callbacks used during training. If checkpoint of interrupted training exists, `fit` resumes from it, so
+    training log is appended instead of being truncated, and epochs after resumption have to beat best val_accuracy
+    logged before interruption to overwrite saved model or to reset early stopping patience. Note that the count of
+    epochs without improvement itself still restarts from zero on resumption.
+    :param local_dir: path to directory to save training artifacts
+    :return: list of callbacks
+    """
     local_dir.mkdir(parents=True, exist_ok=True)
+    backup_dir = local_dir.joinpath("backup")
+    log_path = local_dir.joinpath("training_log.csv")
+    # completed `fit` deletes only checkpoint under `chief` subdirectory and leaves empty backup directory behind
+    is_resumed = tf.train.latest_checkpoint(str(backup_dir.joinpath("chief"))) is not None
+    best_val_accuracy = read_best_val_accuracy(log_path) if is_resumed else None
     checkpoint_callback = tf.keras.callbacks.ModelCheckpoint(
-        filepath=f"{local_dir}/ckpt",
-        save_weights_only=True,
+        filepath=f"{local_dir}/result",
+        save_weights_only=False,
         save_best_only=True,
         save_freq="epoch",
         monitor="val_accuracy",
+        initial_value_threshold=best_val_accuracy,
         verbose=1,
     )
     csv_record_callback = tf.keras.callbacks.CSVLogger(
-        filename=f"{local_dir}/training_log.csv"
+        filename=str(log_path), append=is_resumed
+    )
+    tensorboard_callback = tf.keras.callbacks.TensorBoard(
+        log_dir=f"{local_dir}/tb", profile_batch="10,20", histogram_freq=0, write_graph=False
     )
     early_stopping_callback = tf.keras.callbacks.EarlyStopping(
-        monitor="val_accuracy", patience=5, mode="max"
+        monitor="val_accuracy", patience=5, mode="max", baseline=best_val_accuracy
+    )
+    backup_callback = tf.keras.callbacks.BackupAndRestore(
+        backup_dir=str(backup_dir)
+    )
+    return [checkpoint_callback, csv_record_callback, tensorboard_callback, early_stopping_callback, backup_callback]
+
+
+def serialize_example(image: np.array, label: int) -> bytes:
+    """
+    :param image: raw image whose pixel values are uint8
+    :param label: corresponding label
+    :return: serialized tf.train.Example that contains given image with its label
+    """
+    feature = {
+        "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+        "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+    }
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+def parse_example(serialized: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Inverse of `serialize_example` method
+    :param serialized: serialized tf.train.Example
+    :return: tensor of raw image with its label
+    """
+    features = tf.io.parse_single_example(
+        serialized,
+        features={
+            "image": tf.io.FixedLenFeature([], tf.string),
+            "label": tf.io.FixedLenFeature([], tf.int64),
+        }
     )
-    return [checkpoint_callback, csv_record_callback, early_stopping_callback]
+    image = tf.reshape(tf.io.decode_raw(features["image"], tf.uint8), IMAGE_SHAPE)
+    return image, features["label"]
 
 
-def apply_image_augmentation(image: tf.Tensor, label: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+def cifar10_to_tfrecord(local_dir: pathlib.Path, num_shards: int = NUM_SHARDS) -> Tuple[str, str]:
+    """
+    Convert CIFAR10 data from Keras dataset into sharded TFRecord files, so that training pipeline streams examples from
+    disk instead of holding whole arrays in memory. Conversion of each split is skipped if all of its shards exist,
+    and each shard is written under temporary name first, so that interrupted conversion is not mistaken as complete.
+    :param local_dir: path to directory to save TFRecord files
+    :param num_shards: number of shards per split
+    :return: glob patterns of train and test shards
     """
-    Define series of image augmentation operations to be applied to input image
-    :param image: standardized image whose pixel values fall into [0, 1]
+    dataset = None
+    file_patterns = []
+    for split_index, split in enumerate(["train", "test"]):
+        shard_paths = [
+            local_dir.joinpath(f"{split}-{shard_index:05d}-of-{num_shards:05d}.tfrecord")
+            for shard_index in range(num_shards)
+        ]
+        if not all(shard_path.exists() for shard_path in shard_paths):
+            if dataset is None:
+                logger.info("Load CIFAR10 data from Keras dataset")
+                dataset = tf.keras.datasets.cifar10.load_data()
+            logger.info(f"Write {split} data into {num_shards} TFRecord files")
+            images, labels = dataset[split_index]
+            labels = labels.flatten()
+            for shard_index, shard_path in enumerate(shard_paths):
+                temp_path = shard_path.with_suffix(".tmp")
+                with tf.io.TFRecordWriter(str(temp_path)) as writer:
+                    for image, label in zip(images[shard_index::num_shards], labels[shard_index::num_shards]):
+                        writer.write(serialize_example(image, label))
+                temp_path.rename(shard_path)
+        file_patterns.append(str(local_dir.joinpath(f"{split}-*-of-{num_shards:05d}.tfrecord")))
+    return file_patterns[0], file_patterns[1]
+
+
+def standardize_image(image: tf.Tensor, label: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Convert raw image into float32 tensor whose pixel values fall into [0, 1]
+    :param image: raw image whose pixel values are uint8
     :param label: corresponding label
-    :return: tensor of augmented images with its label
+    :return: tensor of standardized image with its label
     """
-    image = tf.image.random_flip_left_right(image)
-    image = tf.image.random_flip_up_down(image)
-    image = tf.image.random_hue(image, max_delta=0.2)
-    image = tf.image.random_brightness(image, max_delta=0.3)
-    image = tf.clip_by_value(image, clip_value_min=0, clip_value_max=1)
-    return image, label
+    return tf.cast(image, tf.float32) / 255.0, label
 
 
-def get_tf_dataset(images: np.array, labels: np.array, apply_augmentation: bool) -> tf.data.Dataset:
+@tf.function(jit_compile=True)
+def apply_image_augmentation(
+        images: tf.Tensor, labels: tf.Tensor, seed: tf.Tensor
+) -> Tuple[tf.Tensor, tf.Tensor]:
+    """
+    Define series of image augmentation operations to be applied to batch of input images. Random factors are drawn
+    per image, so that each operation is vectorized over the batch and XLA can fuse the whole series into few kernels.
+    Every factor is drawn by stateless random op seeded from given seed, so that the operations neither depend on nor
+    contend for global random state.
+    :param images: batch of standardized images whose pixel values fall into [0, 1]
+    :param labels: corresponding labels
+    :param seed: seed of shape (2,) that is unique to the batch
+    :return: tensor of augmented images with its labels
+    """
+    seeds = tf.random.experimental.stateless_split(seed, num=4)
+    random_shape = [tf.shape(images)[0], 1, 1, 1]
+    flip_left_right = tf.random.stateless_uniform(random_shape, seed=seeds[0]) < 0.5
+    flip_up_down = tf.random.stateless_uniform(random_shape, seed=seeds[1]) < 0.5
+    images = tf.where(flip_left_right, tf.reverse(images, axis=[2]), images)
+    images = tf.where(flip_up_down, tf.reverse(images, axis=[1]), images)
+    hsv_images = tf.image.rgb_to_hsv(images)
+    hue_delta = tf.random.stateless_uniform(random_shape, seed=seeds[2], minval=-0.2, maxval=0.2)
+    hue = tf.math.floormod(hsv_images[..., :1] + hue_delta, 1.0)
+    images = tf.image.hsv_to_rgb(tf.concat([hue, hsv_images[..., 1:]], axis=-1))
+    images = images + tf.random.stateless_uniform(random_shape, seed=seeds[3], minval=-0.3, maxval=0.3)
+    images = tf.clip_by_value(images, clip_value_min=0, clip_value_max=1)
+    return images, labels
+
+
+def get_tf_dataset(file_pattern: str, apply_augmentation: bool, batch_size: int = BATCH_SIZE) -> tf.data.Dataset:
     """
     wrap dataset into tf.data.Dataset API to be iterated within training loop
-    :param images: array of raw images
-    :param labels: array of corresponding label
+    :param file_pattern: glob pattern of TFRecord files written by `cifar10_to_tfrecord` method
     :param apply_augmentation: whether image augmentation has to be applied
+    :param batch_size: global batch size, which is split evenly across replicas under distribution strategy
     :return: tensorflow dataset
     """
+    dataset = (
+        tf.data.Dataset.list_files(file_pattern, shuffle=apply_augmentation)
+        .interleave(
+            tf.data.TFRecordDataset,
+            cycle_length=NUM_SHARDS,
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=not apply_augmentation,
+        )
+    )
     if apply_augmentation:
+        dataset = (
+            dataset.shuffle(buffer_size=10000)
+            .map(parse_example, num_parallel_calls=tf.data.AUTOTUNE)
+            .map(standardize_image, num_parallel_calls=tf.data.AUTOTUNE)
+            .batch(batch_size=batch_size)
+        )
         return (
-            tf.data.Dataset.from_tensor_slices((images / 255, labels))
-            .map(apply_image_augmentation)
-            .shuffle(buffer_size=256)
-            .batch(batch_size=64)
+            tf.data.Dataset.zip((dataset, tf.data.Dataset.counter()))
+            .map(
+                lambda batch, step: apply_image_augmentation(*batch, seed=tf.stack([step, 0])),
+                num_parallel_calls=tf.data.AUTOTUNE,
+            )
+            .prefetch(tf.data.AUTOTUNE)
         )
     else:
         return (
-            tf.data.Dataset.from_tensor_slices((images / 255, labels))
-            .shuffle(buffer_size=256)
-            .batch(batch_size=64)
+            dataset.map(parse_example, num_parallel_calls=tf.data.AUTOTUNE)
+            .map(standardize_image, num_parallel_calls=tf.data.AUTOTUNE)
+            .batch(batch_size=batch_size)
+            .cache()
+            .prefetch(tf.data.AUTOTUNE)
         )
 
 
@@ -149,19 +360,27 @@ if __name__ == '__main__':
     local_dir = pathlib.Path(LOCAL_DIR)
     local_dir.mkdir(exist_ok=True, parents=True)
 
-    logger.info("Load CIFAR10 data from Keras dataset")
-    (train_images, train_labels), (test_images, test_labels) = tf.keras.datasets.cifar10.load_data()
+    train_file_pattern, test_file_pattern = cifar10_to_tfrecord(local_dir)
 
-    logger.info("Train CNN classifier with augmented data")
-    model = define_model_cnn(train_images[0].shape)
+    logger.info(f"Set mixed precision policy to '{set_mixed_precision_policy()}'")
+    strategy = tf.distribute.MirroredStrategy()
+    batch_size = BATCH_SIZE * strategy.num_replicas_in_sync  # each replica gets local batch of BATCH_SIZE samples
+    total_steps = EPOCHS * math.ceil(NUM_TRAIN_EXAMPLES / batch_size)
+    learning_rate = WarmupCosineDecay(
+        # square root scaling rule over base learning rate for batch of 64, which suits Adam better than linear one
+        peak_learning_rate=min(1e-3 * math.sqrt(batch_size / 64), MAX_LEARNING_RATE),
+        # warmup takes at most 10% of the schedule, so that cosine decay spans most of it regardless of replica count
+        warmup_steps=max(min(500, total_steps // 10), 1),
+        total_steps=total_steps,
+    )
+    logger.info(f"Train CNN classifier with augmented data over {strategy.num_replicas_in_sync} replica(s)")
+    with strategy.scope():
+        model = define_model_cnn(IMAGE_SHAPE, learning_rate)
     model.fit(
-        x=get_tf_dataset(train_images, train_labels, True),
-        epochs=30,
+        x=get_tf_dataset(train_file_pattern, True, batch_size),
+        epochs=EPOCHS,
         verbose=2,
         callbacks=define_callbacks(local_dir),
-        validation_data=get_tf_dataset(test_images, test_labels, False),
+        validation_data=get_tf_dataset(test_file_pattern, False, batch_size),
     )
-
-    logger.info("Save trained CNN classifier")
-    model.load_weights(filepath=f"{local_dir}/ckpt")
-    tf.saved_model.save(model, f"{local_dir}/result")
+    logger.info(f"Best CNN classifier is saved to '{local_dir}/result'")